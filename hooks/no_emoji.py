@@ -9,32 +9,299 @@ Removes emoji with smart space handling:
 """
 
 import argparse
+import errno
+import functools
+import mmap
+import os
+import re
+import shutil
 import sys
-from pathlib import Path
-from typing import List, Optional, Sequence, Set
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import (
+    AbstractSet,
+    Any,
+    BinaryIO,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Pattern,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 import emoji
-from emoji import EmojiMatch
 
+# Above this many files, fixing is spread across a pool of worker processes.
+_PARALLEL_THRESHOLD = 4
 
-def parse_whitelist(allow_emoji_args: List[str]) -> Set[str]:
+# Upper bound on files handed to a worker process per task.
+_MAX_CHUNKSIZE = 16
+
+# Size of the blocks read when probing and fixing a file.
+_CHUNK_SIZE = 1 << 20
+_BINARY_SNIFF_SIZE = 8192
+
+# Ranges in a codepoint class separated by at most this many codepoints
+# are merged, keeping the class short and fast to test.
+_CLASS_MAX_GAP = 32
+
+
+def _codepoint_ranges(
+    codepoints: Iterable[int], excluded: AbstractSet[int] = frozenset()
+) -> List[List[int]]:
     """
-    Parse whitelist arguments into set of emoji characters.
+    Coalesce codepoints into a short list of inclusive ranges.
 
     Args:
-        allow_emoji_args: List of emoji (as characters or shortcodes)
+        codepoints: Codepoints the ranges must cover
+        excluded: Codepoints the ranges must not cover
 
     Returns:
-        Set of whitelisted emoji characters
+        Sorted [first, last] ranges; may also cover a few non-ASCII
+        codepoints inside merged gaps, but never misses a given codepoint
+    """
+    ranges: List[List[int]] = []
+    for codepoint in sorted(set(codepoints)):
+        # ASCII is common in source code, so only coalesce above it
+        max_gap = _CLASS_MAX_GAP if codepoint > 0x7F else 1
+        if (
+            ranges
+            and codepoint - ranges[-1][1] <= max_gap
+            and not any(ranges[-1][1] < other < codepoint for other in excluded)
+        ):
+            ranges[-1][1] = codepoint
+        else:
+            ranges.append([codepoint, codepoint])
+    return ranges
+
+
+def _codepoint_class(
+    codepoints: Iterable[int], excluded: AbstractSet[int] = frozenset()
+) -> str:
+    """
+    Build a regex character class covering the given codepoints.
+
+    Args:
+        codepoints: Codepoints the class must match
+        excluded: Codepoints the class must not match
+
+    Returns:
+        Character class pattern, coalesced as by _codepoint_ranges
+    """
+    ranges = _codepoint_ranges(codepoints, excluded)
+    if not ranges:
+        return "(?!)"
+
+    parts = []
+    for first, last in ranges:
+        if first == last:
+            parts.append(re.escape(chr(first)))
+        else:
+            parts.append(f"{re.escape(chr(first))}-{re.escape(chr(last))}")
+    return "[" + "".join(parts) + "]"
+
+
+def _probe_codepoints(whitelist: FrozenSet[str]) -> Tuple[Set[int], Set[int]]:
+    """
+    Collect the codepoints that mark text as holding non-whitelisted emoji.
+
+    Every emoji sequence contains at least one non-ASCII codepoint, so
+    text without any of them needs no further analysis. Codepoints found
+    only in whitelisted sequences are left out, which lets files whose
+    only emoji are whitelisted skip analysis just like emoji-free ones.
+
+    Args:
+        whitelist: Set of whitelisted emoji to preserve
+
+    Returns:
+        Tuple of the codepoints to probe for and those to never match
+    """
+    wanted: Set[int] = set()
+    allowed: Set[int] = set()
+    for sequence in emoji.EMOJI_DATA:
+        codepoints = allowed if sequence in whitelist else wanted
+        codepoints.update(ord(char) for char in sequence if ord(char) > 0x7F)
+    return wanted, allowed - wanted
+
+
+@functools.lru_cache(maxsize=None)
+def _emoji_probe(whitelist: FrozenSet[str]) -> Pattern[str]:
     """
-    whitelist = set()
+    Compile the pattern finding text that may hold non-whitelisted emoji.
+
+    Args:
+        whitelist: Set of whitelisted emoji to preserve
+
+    Returns:
+        Compiled probe pattern
+    """
+    return re.compile(_codepoint_class(*_probe_codepoints(whitelist)))
+
+
+@functools.lru_cache(maxsize=None)
+def _emoji_probe_bytes(whitelist: FrozenSet[str]) -> Pattern[bytes]:
+    """
+    Compile the probe pattern for UTF-8 encoded bytes.
+
+    It matches the encoding of every codepoint the text probe matches, so
+    files can be searched without being decoded first.
+
+    Args:
+        whitelist: Set of whitelisted emoji to preserve
+
+    Returns:
+        Compiled bytes probe pattern
+    """
+    ranges = _codepoint_ranges(*_probe_codepoints(whitelist))
+    if not ranges:
+        return re.compile(b"(?!)")
+
+    # Latin-1 maps each byte to the codepoint of the same value
+    encodings = (
+        chr(codepoint).encode().decode("latin-1")
+        for first, last in ranges
+        for codepoint in range(first, last + 1)
+    )
+    return re.compile(_trie_pattern(encodings).encode("latin-1"))
+
+
+_SPACES = re.compile(" +")
+
+
+def _trie_pattern(sequences: Iterable[str]) -> str:
+    """
+    Build a regex alternation of strings shaped as a prefix tree.
+
+    Strings sharing a prefix share one branch, so the regex engine tests
+    each character against one level of the tree instead of against
+    every string. Longer strings win over their own prefixes.
+
+    Args:
+        sequences: Strings the pattern must match
+
+    Returns:
+        Regex pattern matching any one of the strings
+    """
+    tree: Dict[str, Any] = {}
+    for sequence in sequences:
+        node = tree
+        for char in sequence:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def node_pattern(node: Dict[str, Any]) -> str:
+        branches = [
+            re.escape(char) + node_pattern(child)
+            for char, child in node.items()
+            if char
+        ]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        return pattern + "?" if "" in node else pattern
+
+    return node_pattern(tree)
+
+
+@functools.lru_cache(maxsize=None)
+def _emoji_regex() -> str:
+    """
+    Build the regex source matching one emoji, as found by emoji.analyze.
+
+    Longer sequences win so that ZWJ sequences, skin tones and keycaps
+    beat their components, and emoji joined by ZWJ into a sequence that
+    is not listed themselves still match as a whole. Like emoji.analyze,
+    a join may hold extra ZWJ and FE0F characters, while a ZWJ that
+    joins nothing is not part of the match.
+
+    Returns:
+        Regex pattern source
+    """
+    any_emoji = _trie_pattern(emoji.EMOJI_DATA)
+    first_char = _codepoint_class(ord(sequence[0]) for sequence in emoji.EMOJI_DATA)
+    joiner = "\ufe0f*\u200d[\u200d\ufe0f]*"
+    return (
+        f"(?={first_char})(?:{any_emoji})(?:{joiner}(?={first_char})(?:{any_emoji}))*"
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _emoji_pattern() -> Pattern[str]:
+    """
+    Compile the pattern matching one emoji.
+
+    Compiling takes a noticeable fraction of a second, so it is deferred
+    until a file actually contains emoji candidates.
+
+    Returns:
+        Compiled emoji pattern
+    """
+    return re.compile(_emoji_regex())
+
+
+@functools.lru_cache(maxsize=None)
+def _emoji_run_pattern() -> Pattern[str]:
+    """
+    Compile the pattern matching a run of emoji with its spaces.
+
+    A run is one or more emoji separated only by spaces. Group 1 holds
+    the spaces before the run, group 2 the emoji and group 3 the spaces
+    after it. Removing emoji one at a time, right to left, with the space
+    priority rules always empties the run and keeps the leading spaces
+    only when trailing spaces exist, so a whole run is removed at once.
+
+    Returns:
+        Compiled emoji run pattern
+    """
+    single = _emoji_regex()
+    run_start = _codepoint_class(
+        {ord(" ")} | {ord(sequence[0]) for sequence in emoji.EMOJI_DATA}
+    )
+    return re.compile(
+        f"(?={run_start})((?<! ) +)?((?:{single})(?: +(?:{single}))*)( *)"
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _emojize(shortcode: str) -> str:
+    """Convert a single shortcode such as :rocket: to its emoji."""
+    return emoji.emojize(shortcode)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_whitelist(allow_emoji_args: FrozenSet[str]) -> FrozenSet[str]:
+    """Cached implementation of parse_whitelist."""
+    whitelist: Set[str] = set()
     for item in allow_emoji_args:
         if item.startswith(":") and item.endswith(":"):
-            converted = emoji.emojize(item)
+            converted = _emojize(item)
             whitelist.add(converted)
         else:
             whitelist.add(item)
-    return whitelist
+    return frozenset(sys.intern(item) for item in whitelist)
+
+
+def parse_whitelist(allow_emoji_args: List[str]) -> FrozenSet[str]:
+    """
+    Parse whitelist arguments into set of emoji characters.
+
+    Args:
+        allow_emoji_args: List of emoji (as characters or shortcodes)
+
+    Returns:
+        Set of whitelisted emoji characters
+    """
+    return _parse_whitelist(frozenset(allow_emoji_args))
 
 
 def remove_emoji_with_spaces(
@@ -57,28 +324,136 @@ def remove_emoji_with_spaces(
     Returns:
         Text with emoji and appropriate spaces removed
     """
-    trailing_spaces = 0
-    pos = end_pos
-    while pos < len(text) and text[pos] == " ":
-        trailing_spaces += 1
-        pos += 1
+    # Kept for API compatibility; the hook itself removes whole runs of
+    # emoji with the same priority in _fix_text and _fix_run
+    trailing = _SPACES.match(text, end_pos)
+    if trailing:
+        return text[:start_pos] + text[trailing.end() :]
+
+    return text[:start_pos].rstrip(" ") + text[end_pos:]
+
+
+def _fix_text(text: str, whitelist: FrozenSet[str]) -> str:
+    """
+    Remove all non-whitelisted emoji from a block of whole lines.
+
+    Only the rest of each line from the first probe hit goes through the
+    emoji pattern, where each run of emoji is replaced in a single regex
+    substitution. Neither emoji nor the spaces removed with them extend
+    past a newline, so a block gives the same result as fixing each of its
+    lines separately.
+
+    Args:
+        text: Text to fix
+        whitelist: Set of whitelisted emoji to preserve
+
+    Returns:
+        Text with emoji and appropriate spaces removed
+    """
+    probe = _emoji_probe(whitelist)
+    run_pattern = _emoji_run_pattern()
+
+    def fix_run(run: Match[str]) -> str:
+        leading, emojis, trailing = run.groups()
+        if whitelist and any(item in emojis for item in whitelist):
+            return _fix_run(run.group(), whitelist)
+        if trailing:
+            return leading or ""
+        return ""
+
+    pieces = []
+    pos = 0
+    hit = probe.search(text)
+    while hit:
+        # A run starts at most one character before the first candidate, at
+        # a keycap base such as "1", plus the spaces in front of it
+        run_start = pos + len(text[pos : max(pos, hit.start() - 1)].rstrip(" "))
+        line_end = text.find("\n", hit.end()) + 1
+        if not line_end:
+            line_end = len(text)
+
+        pieces.append(text[pos:run_start])
+        pieces.append(run_pattern.sub(fix_run, text[run_start:line_end]))
+        pos = line_end
+        hit = probe.search(text, pos)
+
+    if not pieces:
+        return text
+
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+def _emoji_runs(text: str, whitelist: AbstractSet[str]) -> Iterator[Tuple[int, int]]:
+    """
+    Find the runs of non-whitelisted emoji in text, left to right.
+
+    Runs are split like those matched by _emoji_run_pattern, and a
+    whitelisted emoji ends a run like any other text.
+
+    Args:
+        text: Text to search
+        whitelist: Set of whitelisted emoji to preserve
+
+    Yields:
+        Tuple of (start, end) positions of each run, without its spaces
+    """
+    run: Optional[Tuple[int, int]] = None
+    for match in _emoji_pattern().finditer(text):
+        if whitelist and match.group() in whitelist:
+            continue
+
+        start, end = match.span()
+        if run and start > run[1] and not text[run[1] : start].strip(" "):
+            run = (run[0], end)
+            continue
+
+        if run:
+            yield run
+        run = (start, end)
+
+    if run:
+        yield run
+
+
+def _fix_run(text: str, whitelist: AbstractSet[str]) -> str:
+    """
+    Remove non-whitelisted emoji from text that also holds whitelisted ones.
+
+    Each run of removable emoji keeps its leading spaces only if it has
+    trailing spaces, the same result as removing its emoji one at a
+    time, right to left, but found in a single forward pass.
+
+    Args:
+        text: Text to fix
+        whitelist: Set of whitelisted emoji to preserve
+
+    Returns:
+        Text with emoji and appropriate spaces removed
+    """
+    pieces = []
+    pos = 0
 
-    if trailing_spaces > 0:
-        return text[:start_pos] + text[end_pos + trailing_spaces :]
+    for start, end in _emoji_runs(text, whitelist):
+        trailing = _SPACES.match(text, end)
+        if trailing:
+            cut_start, cut_end = start, trailing.end()
+        else:
+            cut_start, cut_end = pos + len(text[pos:start].rstrip(" ")), end
 
-    leading_spaces = 0
-    pos = start_pos - 1
-    while pos >= 0 and text[pos] == " ":
-        leading_spaces += 1
-        pos -= 1
+        pieces.append(text[pos:cut_start])
+        pos = cut_end
 
-    if leading_spaces > 0:
-        return text[: start_pos - leading_spaces] + text[end_pos:]
+    if not pieces:
+        return text
 
-    return text[:start_pos] + text[end_pos:]
+    pieces.append(text[pos:])
+    return "".join(pieces)
 
 
-def fix_file(filepath: Path, whitelist: Set[str]) -> bool:
+def fix_file(
+    filepath: "Union[str, os.PathLike[str]]", whitelist: AbstractSet[str]
+) -> bool:
     """
     Fix file in-place by removing emoji and surrounding spaces.
 
@@ -88,40 +463,217 @@ def fix_file(filepath: Path, whitelist: Set[str]) -> bool:
 
     Returns:
         True if modifications were made, False otherwise
+
+    Raises:
+        PermissionError: If the file needs fixing but is read-only
     """
+    whitelist = frozenset(whitelist)
+    probe = _emoji_probe_bytes(whitelist)
+
     try:
-        with open(filepath, encoding="utf-8") as f:
-            lines = f.readlines()
-    except (UnicodeDecodeError, PermissionError):
+        with open(filepath, "rb") as f:
+            # Empty files cannot be mapped, and hold no emoji anyway
+            if not os.fstat(f.fileno()).st_size:
+                return False
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Like git, treat a NUL byte near the start as a binary file
+                if mapped.find(b"\x00", 0, _BINARY_SNIFF_SIZE) != -1:
+                    return False
+
+                for start in range(0, len(mapped), _CHUNK_SIZE):
+                    end = start + _CHUNK_SIZE
+                    # Emoji are never ASCII, so pure ASCII needs no search;
+                    # a match may run up to 3 bytes past the chunk
+                    if not mapped[start:end].isascii() and probe.search(
+                        mapped, start, end + 3
+                    ):
+                        break
+                else:
+                    return False
+    except PermissionError:
         return False
 
-    modified = False
-    fixed_lines = []
+    try:
+        with open(filepath, encoding="utf-8", newline="") as f:
+            tmp_path = _write_fixed(f, filepath, whitelist)
+    except UnicodeDecodeError:
+        return False
 
-    for line in lines:
-        emoji_matches = list(emoji.analyze(line))
+    # The original is closed by now, which Windows needs to replace it
+    if tmp_path is None:
+        return False
+    _replace_file(filepath, tmp_path)
+    return True
 
-        if emoji_matches:
-            for match in reversed(emoji_matches):
-                emoji_char = match.chars
 
-                if emoji_char in whitelist:
+def _write_fixed(
+    source: TextIO, filepath: "Union[str, os.PathLike[str]]", whitelist: FrozenSet[str]
+) -> Optional[str]:
+    """
+    Stream fixed blocks into a temporary file next to the original.
+
+    The temporary file is only created once a block changes, starting
+    with a copy of the unchanged bytes before it, so unchanged files
+    cause no writes at all. If the directory of the original is not
+    writable, it is created in the default temporary directory instead.
+    Blocks are extended to the end of their last line so no emoji is
+    split between two.
+
+    Args:
+        source: Original file, opened for reading at its start
+        filepath: Path to file to fix
+        whitelist: Set of whitelisted emoji to preserve
+
+    Returns:
+        Path of the temporary file holding the fixed text, or None if
+        nothing changed
+    """
+    directory = os.path.dirname(os.path.realpath(filepath))
+    probe = _emoji_probe(whitelist)
+    unchanged_size = 0
+    target: Optional[BinaryIO] = None
+    tmp_path = ""
+
+    try:
+        for block in iter(functools.partial(source.read, _CHUNK_SIZE), ""):
+            if not block.endswith("\n"):
+                block += source.readline()
+
+            fixed = _fix_text(block, whitelist) if probe.search(block) else block
+            if target is None:
+                if fixed == block:
+                    unchanged_size += len(block.encode("utf-8"))
                     continue
 
-                if isinstance(match.value, EmojiMatch):
-                    start = match.value.start
-                    end = match.value.end
+                try:
+                    fd, tmp_path = tempfile.mkstemp(prefix=".no-emoji-", dir=directory)
+                except PermissionError:
+                    # The file may still be writable in a read-only
+                    # directory, and is then rewritten in place
+                    fd, tmp_path = tempfile.mkstemp(prefix=".no-emoji-")
+                target = open(fd, "wb")
+                with open(filepath, "rb") as original:
+                    _copy_prefix(original, target, unchanged_size)
+            target.write(fixed.encode("utf-8"))
+    except BaseException:
+        if target is not None:
+            target.close()
+            os.unlink(tmp_path)
+        raise
+
+    if target is None:
+        return None
+    target.close()
+    return tmp_path
+
+
+def _replace_file(filepath: "Union[str, os.PathLike[str]]", tmp_path: str) -> None:
+    """
+    Move a fixed temporary file over the original.
 
-                    line = remove_emoji_with_spaces(line, emoji_char, start, end)
-                    modified = True
+    A symlink keeps pointing at its target, which is what gets replaced.
+    The rename is atomic, but it would split hard links and drop an owner
+    or extended attributes the temporary file cannot take over, so such
+    files are rewritten in place instead, as are files whose temporary
+    file had to be created elsewhere. Read-only files, including ones
+    without any write bit that root could still write, are not modified.
 
-        fixed_lines.append(line)
+    Args:
+        filepath: Path to file to fix
+        tmp_path: Path of the temporary file holding the fixed text
+
+    Raises:
+        PermissionError: If the original file is read-only
+    """
+    target = os.path.realpath(filepath)
+    replaced = False
+
+    try:
+        stat = os.stat(target)
+        if not stat.st_mode & 0o222 or not os.access(target, os.W_OK):
+            raise PermissionError(errno.EACCES, "File is read-only", str(filepath))
+
+        same_directory = os.path.dirname(tmp_path) == os.path.dirname(target)
+        if same_directory and _adopt_identity(target, tmp_path, stat):
+            os.replace(tmp_path, target)
+            replaced = True
+        else:
+            with open(tmp_path, "rb") as fixed, open(target, "r+b") as original:
+                shutil.copyfileobj(fixed, original)
+                original.truncate()
+    finally:
+        if not replaced:
+            os.unlink(tmp_path)
 
-    if modified:
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.writelines(fixed_lines)
 
-    return modified
+def _adopt_identity(target: str, tmp_path: str, stat: os.stat_result) -> bool:
+    """
+    Give a temporary file the owner, attributes and mode of the original.
+
+    Args:
+        target: Path of the original file, with symlinks resolved
+        tmp_path: Path of the temporary file
+        stat: Status of the original file
+
+    Returns:
+        True if the temporary file can replace the original, False if the
+        original has other hard links or its identity could not be copied
+    """
+    if stat.st_nlink > 1:
+        return False
+
+    try:
+        tmp_stat = os.stat(tmp_path)
+        if (tmp_stat.st_uid, tmp_stat.st_gid) != (stat.st_uid, stat.st_gid):
+            os.chown(tmp_path, stat.st_uid, stat.st_gid)
+        if hasattr(os, "listxattr"):
+            for name in os.listxattr(target):
+                os.setxattr(tmp_path, name, os.getxattr(target, name))
+    except OSError:
+        return False
+
+    # After chown, which may clear set-user-ID and set-group-ID bits
+    shutil.copymode(target, tmp_path)
+    return True
+
+
+def _copy_prefix(source: BinaryIO, target: BinaryIO, size: int) -> None:
+    """
+    Copy the first bytes of a file into another.
+
+    Args:
+        source: File to copy from, at its start
+        target: File to copy to
+        size: Number of bytes to copy
+    """
+    while size > 0:
+        chunk = source.read(min(size, _CHUNK_SIZE))
+        if not chunk:
+            break
+        target.write(chunk)
+        size -= len(chunk)
+
+
+_worker_whitelist: AbstractSet[str] = frozenset()
+
+
+def _init_worker(whitelist: AbstractSet[str]) -> None:
+    """
+    Prepare a worker process for _fix_file_worker.
+
+    Stores the whitelist and builds the bytes probe, which every file
+    needs, while the pool starts. The emoji patterns are still compiled
+    lazily, since most runs never meet an emoji.
+    """
+    global _worker_whitelist
+    _worker_whitelist = frozenset(whitelist)
+    _emoji_probe_bytes(_worker_whitelist)
+
+
+def _fix_file_worker(filename: str) -> bool:
+    """Fix a single file inside a worker process."""
+    return fix_file(filename, _worker_whitelist)
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -155,14 +707,26 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
 
     whitelist = parse_whitelist(args.allow_emoji)
 
-    modified_files = []
-
-    for filename in args.filenames:
-        filepath = Path(filename)
-        was_modified = fix_file(filepath, whitelist)
-
-        if was_modified:
-            modified_files.append(filename)
+    # pre-commit runs the hook in a single process (require_serial), so
+    # the pool is the only source of parallelism; with one CPU it would
+    # only add start-up cost
+    workers = os.cpu_count() or 1
+    if workers > 1 and len(args.filenames) > _PARALLEL_THRESHOLD:
+        chunksize = max(1, min(_MAX_CHUNKSIZE, len(args.filenames) // workers))
+        with ProcessPoolExecutor(
+            initializer=_init_worker, initargs=(whitelist,)
+        ) as executor:
+            results = list(
+                executor.map(_fix_file_worker, args.filenames, chunksize=chunksize)
+            )
+    else:
+        results = [fix_file(filename, whitelist) for filename in args.filenames]
+
+    modified_files = [
+        filename
+        for filename, was_modified in zip(args.filenames, results)
+        if was_modified
+    ]
 
     if modified_files:
         print(
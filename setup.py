@@ -1,5 +1,14 @@
+import os
+
 from setuptools import setup, find_packages
 
+ext_modules = []
+# Compiling with mypyc is opt-in; without it the pure Python module is used.
+if os.environ.get("NO_EMOJI_USE_MYPYC") == "1":
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(["hooks/no_emoji.py"])
+
 setup(
     name="pre-commit-hooks",
     version="2.0.0",
@@ -8,6 +17,7 @@ setup(
     install_requires=[
         "emoji>=2.15.0",
     ],
+    ext_modules=ext_modules,
     entry_points={
         "console_scripts": [
             "no-emoji=hooks.no_emoji:main",
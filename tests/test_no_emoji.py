@@ -1,6 +1,10 @@
+import os
 import tempfile
 from pathlib import Path
 
+import pytest
+
+from hooks import no_emoji
 from hooks.no_emoji import fix_file, main, parse_whitelist, remove_emoji_with_spaces
 
 
@@ -159,6 +163,26 @@ def test_fix_file_no_emoji():
         filepath.unlink()
 
 
+def test_fix_file_space_separated_emoji_at_line_end():
+    """Test emoji separated only by spaces leave no trailing space."""
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".py", delete=False, encoding="utf-8"
+    ) as f:
+        f.write("# Done 😊 🎉\n")
+        f.write("# Done ✅ 🎉\n")
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, {"✅"})
+        assert result is True
+
+        with open(filepath, encoding="utf-8") as f:
+            content = f.read()
+        assert content == "# Done\n# Done ✅\n"
+    finally:
+        filepath.unlink()
+
+
 def test_fix_file_with_whitelist():
     """Test whitelist preserves specific emoji."""
     with tempfile.NamedTemporaryFile(
@@ -181,6 +205,225 @@ def test_fix_file_with_whitelist():
         filepath.unlink()
 
 
+def test_fix_file_whitelisted_emoji_within_run():
+    """Test whitelisted emoji split a run of emoji to remove."""
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".py", delete=False, encoding="utf-8"
+    ) as f:
+        f.write("Done ✅ 🎉 🚀 ok ✅ 🎉\n")
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, {"✅"})
+        assert result is True
+
+        with open(filepath, encoding="utf-8") as f:
+            content = f.read()
+        assert content == "Done ✅ ok ✅\n"
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_preserves_crlf_line_endings():
+    """Test fixing file keeps CRLF line endings intact."""
+    with tempfile.NamedTemporaryFile(mode="wb", suffix=".py", delete=False) as f:
+        f.write("# Comment 😊 here\r\n".encode())
+        f.write(b'print("test")\r\n')
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, set())
+        assert result is True
+
+        with open(filepath, "rb") as f:
+            content = f.read()
+        assert content == b'# Comment here\r\nprint("test")\r\n'
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_without_removals_is_not_rewritten():
+    """Test a file with emoji candidates but nothing to remove is untouched."""
+    content = "«Bonjour»\r\nplain line\n".encode()
+    with tempfile.NamedTemporaryFile(mode="wb", suffix=".py", delete=False) as f:
+        f.write(content)
+        filepath = Path(f.name)
+
+    try:
+        before = filepath.stat()
+        result = fix_file(filepath, set())
+        assert result is False
+
+        after = filepath.stat()
+        assert filepath.read_bytes() == content
+        assert after.st_ino == before.st_ino
+        assert after.st_mtime_ns == before.st_mtime_ns
+        assert not list(filepath.parent.glob(".no-emoji-*"))
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_emoji_after_unchanged_blocks(monkeypatch):
+    """Test unchanged blocks before the first removal are kept verbatim."""
+    monkeypatch.setattr(no_emoji, "_CHUNK_SIZE", 4)
+    with tempfile.NamedTemporaryFile(mode="wb", suffix=".py", delete=False) as f:
+        f.write("«a»\r\nplain\r\nparty 🎉\r\nend\n".encode())
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, set())
+        assert result is True
+        assert filepath.read_bytes() == "«a»\r\nplain\r\nparty\r\nend\n".encode()
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_emoji_across_block_boundaries(monkeypatch):
+    """Test emoji are removed correctly when a file is read in small blocks."""
+    monkeypatch.setattr(no_emoji, "_CHUNK_SIZE", 4)
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".py", delete=False, encoding="utf-8"
+    ) as f:
+        f.write("# Family 👨‍👩‍👧‍👦 test\n")
+        f.write("# Wave 👋🏻 bye 🎉\n")
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, set())
+        assert result is True
+
+        with open(filepath, encoding="utf-8") as f:
+            content = f.read()
+        assert content == "# Family test\n# Wave bye\n"
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_preserves_permissions():
+    """Test fixing file keeps its permission bits."""
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".sh", delete=False, encoding="utf-8"
+    ) as f:
+        f.write("echo 'done 😊'\n")
+        filepath = Path(f.name)
+
+    try:
+        filepath.chmod(0o755)
+        result = fix_file(filepath, set())
+        assert result is True
+        assert filepath.stat().st_mode & 0o777 == 0o755
+
+        with open(filepath, encoding="utf-8") as f:
+            content = f.read()
+        assert content == "echo 'done'\n"
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_through_symlink():
+    """Test fixing a symlink fixes its target and keeps the link."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        target = Path(tmpdir) / "target.py"
+        target.write_text("# Party 🎉 time\n", encoding="utf-8")
+        link = Path(tmpdir) / "link.py"
+        link.symlink_to(target)
+
+        result = fix_file(link, set())
+        assert result is True
+        assert link.is_symlink()
+        assert target.read_text(encoding="utf-8") == "# Party time\n"
+
+
+def test_fix_file_with_hard_link():
+    """Test fixing a file is visible through its other hard links."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = Path(tmpdir) / "file.py"
+        filepath.write_text("# Party 🎉 time\n", encoding="utf-8")
+        other = Path(tmpdir) / "other.py"
+        os.link(filepath, other)
+
+        result = fix_file(filepath, set())
+        assert result is True
+        assert filepath.stat().st_ino == other.stat().st_ino
+        assert other.read_text(encoding="utf-8") == "# Party time\n"
+
+
+def test_fix_file_read_only():
+    """Test read-only files are reported and left unchanged."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = Path(tmpdir) / "file.py"
+        filepath.write_text("# Party 🎉 time\n", encoding="utf-8")
+        filepath.chmod(0o444)
+
+        with pytest.raises(PermissionError):
+            fix_file(filepath, set())
+        assert filepath.read_text(encoding="utf-8") == "# Party 🎉 time\n"
+        assert [p.name for p in Path(tmpdir).iterdir()] == ["file.py"]
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "geteuid") or os.geteuid() == 0,
+    reason="needs a user that directory permissions apply to",
+)
+def test_fix_file_in_read_only_directory():
+    """Test a writable file in a read-only directory is still fixed."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = Path(tmpdir) / "sub"
+        directory.mkdir()
+        filepath = directory / "file.py"
+        filepath.write_text("# Party 🎉 time\n", encoding="utf-8")
+        directory.chmod(0o555)
+
+        try:
+            assert main([str(filepath)]) == 1
+            assert filepath.read_text(encoding="utf-8") == "# Party time\n"
+            assert [p.name for p in directory.iterdir()] == ["file.py"]
+        finally:
+            directory.chmod(0o755)
+
+
+def test_fix_file_when_directory_rejects_temporary_file(monkeypatch):
+    """Test a file is rewritten in place if no temporary file fits beside it."""
+    mkstemp = tempfile.mkstemp
+
+    def reject_directory(*args, **kwargs):
+        if "dir" in kwargs:
+            raise PermissionError("read-only directory")
+        return mkstemp(*args, **kwargs)
+
+    monkeypatch.setattr(tempfile, "mkstemp", reject_directory)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = Path(tmpdir) / "file.py"
+        filepath.write_text("# Party 🎉 time\n", encoding="utf-8")
+        inode = filepath.stat().st_ino
+
+        result = fix_file(filepath, set())
+        assert result is True
+        assert filepath.stat().st_ino == inode
+        assert filepath.read_text(encoding="utf-8") == "# Party time\n"
+        assert [p.name for p in Path(tmpdir).iterdir()] == ["file.py"]
+
+
+def test_fix_file_only_whitelisted_emoji_skips_analysis(monkeypatch):
+    """Test files whose only emoji are whitelisted are not analyzed."""
+
+    def fail(*args):
+        raise AssertionError("file should not have been analyzed")
+
+    monkeypatch.setattr(no_emoji, "_fix_text", fail)
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".py", delete=False, encoding="utf-8"
+    ) as f:
+        f.write("# TODO ✅ done\n")
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, {"✅"})
+        assert result is False
+    finally:
+        filepath.unlink()
+
+
 def test_fix_file_binary():
     """Test binary files don't crash."""
     with tempfile.NamedTemporaryFile(mode="wb", suffix=".bin", delete=False) as f:
@@ -194,6 +437,34 @@ def test_fix_file_binary():
         filepath.unlink()
 
 
+def test_fix_file_empty():
+    """Test empty files are left alone."""
+    with tempfile.NamedTemporaryFile(mode="wb", suffix=".py", delete=False) as f:
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, set())
+        assert result is False
+        assert filepath.read_bytes() == b""
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_nul_byte_in_head_is_binary():
+    """Test files with a NUL byte near the start are left alone."""
+    content = b"\x00" + "Valid UTF-8 with emoji 🎉\n".encode()
+    with tempfile.NamedTemporaryFile(mode="wb", suffix=".bin", delete=False) as f:
+        f.write(content)
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, set())
+        assert result is False
+        assert filepath.read_bytes() == content
+    finally:
+        filepath.unlink()
+
+
 def test_fix_file_complex_emoji_zwj():
     """Test fixing file with ZWJ sequences (family emoji)."""
     with tempfile.NamedTemporaryFile(
@@ -214,6 +485,46 @@ def test_fix_file_complex_emoji_zwj():
         filepath.unlink()
 
 
+def test_fix_file_emoji_with_stray_joiners():
+    """Test repeated ZWJ and FE0F between emoji are removed with them."""
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".py", delete=False, encoding="utf-8"
+    ) as f:
+        f.write("a 🎉\u200d\u200d🎉 b\n")
+        f.write("1🧑🏾\u200d❤\u200d🧑🏼\u200d\u200d😉\n")
+        f.write("c 🎉\ufe0f\u200d🎉 d\n")
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, set())
+        assert result is True
+
+        with open(filepath, encoding="utf-8") as f:
+            content = f.read()
+        assert content == "a b\n1\nc d\n"
+    finally:
+        filepath.unlink()
+
+
+def test_fix_file_trailing_joiner_is_kept():
+    """Test a ZWJ that joins nothing is left behind, unlike the emoji."""
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".py", delete=False, encoding="utf-8"
+    ) as f:
+        f.write("Love ❤️\u200d x\n")
+        filepath = Path(f.name)
+
+    try:
+        result = fix_file(filepath, set())
+        assert result is True
+
+        with open(filepath, encoding="utf-8") as f:
+            content = f.read()
+        assert content == "Love\u200d x\n"
+    finally:
+        filepath.unlink()
+
+
 def test_fix_file_complex_emoji_skin_tone():
     """Test fixing file with skin tone modifiers."""
     with tempfile.NamedTemporaryFile(
@@ -359,3 +670,56 @@ def test_main_multiple_files():
     finally:
         for filepath in files:
             filepath.unlink()
+
+
+def test_main_single_cpu_runs_serially(monkeypatch):
+    """Test main does not start a pool on a single CPU."""
+    monkeypatch.setattr(os, "cpu_count", lambda: 1)
+    monkeypatch.setattr(no_emoji, "ProcessPoolExecutor", None)
+    files = []
+    try:
+        for i in range(8):
+            f = tempfile.NamedTemporaryFile(
+                mode="w", suffix=".py", delete=False, encoding="utf-8"
+            )
+            f.write(f'print("emoji 😊 {i}")\n')
+            f.close()
+            files.append(Path(f.name))
+
+        assert main([str(f) for f in files]) == 1
+        for i, filepath in enumerate(files):
+            assert filepath.read_text(encoding="utf-8") == f'print("emoji {i}")\n'
+    finally:
+        for filepath in files:
+            filepath.unlink()
+
+
+def test_main_many_files_in_parallel(monkeypatch):
+    """Test main fixes every file when processing them in parallel."""
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    files = []
+    try:
+        for i in range(8):
+            f = tempfile.NamedTemporaryFile(
+                mode="w", suffix=".py", delete=False, encoding="utf-8"
+            )
+            if i % 2 == 0:
+                f.write(f'print("clean {i}")\n')
+            else:
+                f.write(f'print("emoji 😊 {i}")\n')
+            f.close()
+            files.append(Path(f.name))
+
+        result = main(["--allow-emoji", "✅", *[str(f) for f in files]])
+        assert result == 1
+
+        for i, filepath in enumerate(files):
+            with open(filepath, encoding="utf-8") as f:
+                content = f.read()
+            if i % 2 == 0:
+                assert content == f'print("clean {i}")\n'
+            else:
+                assert content == f'print("emoji {i}")\n'
+    finally:
+        for filepath in files:
+            filepath.unlink()